@@ -1,7 +1,15 @@
 import os
 import sys
+import asyncio
 import datetime
-from flask import Flask, render_template, request, send_file, jsonify
+import mimetypes
+import uuid
+import multiprocessing
+import threading
+import concurrent.futures
+from concurrent.futures.process import BrokenProcessPool
+from flask import Flask, render_template, request, send_file
+import orjson
 from werkzeug.utils import secure_filename
 import reconciliation_v2  # Import the existing logic
 
@@ -35,6 +43,41 @@ os.makedirs(RESULTS_FOLDER, exist_ok=True)
 app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
 app.config['RESULTS_FOLDER'] = RESULTS_FOLDER
 
+# Let a fronting web server stream downloads from disk instead of the Python process.
+# USE_X_SENDFILE=1 for servers that honour X-Sendfile (Apache, lighttpd).
+# X_ACCEL_PREFIX=/<internal location> for nginx, where that location aliases the uploads folder.
+# Both are off by default since Render serves the app directly.
+X_ACCEL_PREFIX = os.environ.get('X_ACCEL_PREFIX', '')
+app.config['USE_X_SENDFILE'] = os.environ.get('USE_X_SENDFILE') == '1'
+
+# Reconciliation is CPU-bound Python, so run it in separate processes to
+# let concurrent uploads use more than one core.
+# One worker per request thread (gunicorn --threads 4 in the Procfile); more could never be busy
+RECON_WORKERS = 4
+
+def make_executor():
+    # forkserver starts workers from a clean process rather than forking the threaded gunicorn worker
+    ctx = multiprocessing.get_context('forkserver')
+    ctx.set_forkserver_preload(['reconciliation_v2'])
+    return concurrent.futures.ProcessPoolExecutor(
+        max_workers=min(os.cpu_count() or 1, RECON_WORKERS),
+        mp_context=ctx
+    )
+
+executor = make_executor()
+executor_lock = threading.Lock()
+
+def reset_executor(broken):
+    # A pool whose worker died (e.g. OOM-killed) rejects every later submit; replace it once
+    global executor
+    with executor_lock:
+        if executor is broken:
+            executor = make_executor()
+
+def json_response(data, status=200):
+    # orjson serializes straight to bytes and is much faster than jsonify's stdlib encoder
+    return app.response_class(orjson.dumps(data), status=status, mimetype='application/json')
+
 def allowed_file(filename):
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
@@ -43,19 +86,20 @@ def index():
     return render_template('index.html')
 
 @app.route('/upload', methods=['POST'])
-def upload_file():
+async def upload_file():
     if 'file' not in request.files:
-        return jsonify({'error': 'No file part'}), 400
+        return json_response({'error': 'No file part'}, 400)
     
     file = request.files['file']
     
     if file.filename == '':
-        return jsonify({'error': 'No selected file'}), 400
+        return json_response({'error': 'No selected file'}, 400)
     
     if file and allowed_file(file.filename):
         filename = secure_filename(file.filename)
         timestamp = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
-        save_path = os.path.join(app.config['UPLOAD_FOLDER'], f"{timestamp}_{filename}")
+        # The random part keeps two uploads of the same file name in the same second apart
+        save_path = os.path.join(app.config['UPLOAD_FOLDER'], f"{timestamp}_{uuid.uuid4().hex}_{filename}")
         file.save(save_path)
         
         # Determine sheets if provided
@@ -63,6 +107,7 @@ def upload_file():
         sheet2 = request.form.get('sheet2')
         tolerance = float(request.form.get('tolerance', 1.0))
         
+        pool = executor
         try:
             # Process the file using the imported module
             # We need to capture the output path returned by process_reconciliation
@@ -72,27 +117,34 @@ def upload_file():
             # Call the processing function
             # Note: We might need to modify reconciliation_v2 slightly if it prints too much or handle return values better
             # But relying on the existing 'return out_file' at the end of process_reconciliation
+            # Run it in the process pool. The view still holds its request thread while it waits;
+            # concurrent uploads come from gunicorn's --threads 4, and the pool lets them use separate cores
             
-            output_file = reconciliation_v2.process_reconciliation(
+            future = pool.submit(
+                reconciliation_v2.process_reconciliation,
                 path=abs_save_path,
                 sheet1=sheet1 if sheet1 else None, 
                 sheet2=sheet2 if sheet2 else None,
                 tolerance=tolerance
             )
+            output_file = await asyncio.wrap_future(future)
             
             if output_file and os.path.exists(output_file):
                 # Return the filename for the download link
-                return jsonify({
+                return json_response({
                     'message': 'Reconciliation successful!',
                     'download_url': f'/download?file={os.path.basename(output_file)}'
                 })
             else:
-                 return jsonify({'error': 'Reconciliation failed to produce an output file.'}), 500
+                 return json_response({'error': 'Reconciliation failed to produce an output file.'}, 500)
 
+        except BrokenProcessPool:
+            reset_executor(pool)
+            return json_response({'error': 'Reconciliation worker crashed. Please try again.'}, 500)
         except Exception as e:
-            return jsonify({'error': str(e)}), 500
+            return json_response({'error': str(e)}, 500)
             
-    return jsonify({'error': 'Invalid file type'}), 400
+    return json_response({'error': 'Invalid file type'}, 400)
 
 @app.route('/download')
 def download():
@@ -116,7 +168,19 @@ def download():
         else:
             return "File not found", 404
 
-    return send_file(file_path, as_attachment=True)
+    # nginx can only reach files under the internal location that aliases the uploads folder,
+    # so anything else (the root folder fallback above) is still sent by the app
+    in_uploads = os.path.dirname(os.path.abspath(file_path)) == os.path.abspath(app.config['UPLOAD_FOLDER'])
+    if X_ACCEL_PREFIX and in_uploads:
+        basename = os.path.basename(file_path)
+        response = app.response_class(mimetype=mimetypes.guess_type(basename)[0] or 'application/octet-stream')
+        response.headers['X-Accel-Redirect'] = f"{X_ACCEL_PREFIX.rstrip('/')}/{basename}"
+        response.headers.set('Content-Disposition', 'attachment', filename=basename)
+        return response
+    
+    # Conditional response: ETag/Last-Modified let clients revalidate and support range requests
+    return send_file(file_path, as_attachment=True, conditional=True, etag=True,
+                     last_modified=os.path.getmtime(file_path))
 
 if __name__ == '__main__':
     app.run(host='0.0.0.0', port=5000, debug=True)
@@ -1,6 +1,5 @@
-import openpyxl
-from openpyxl import load_workbook
-from openpyxl.utils import get_column_letter
+import xlsxwriter
+from python_calamine import CalamineWorkbook
 import os
 import sys
 import glob
@@ -8,16 +7,43 @@ import re
 from collections import defaultdict
 import datetime
 import bisect
-import gc
+import functools
+import itertools
 
 # --- Configuration ---
 DEFAULT_TOLERANCE = 1.0  # Default amount tolerance if not specified
 
+# Header keywords for each logical column, highest priority first
+FIELD_KEYWORDS = {
+    'gstin': ('gstin', 'gst number', 'gst no', 'tin'),
+    'party': ('party', 'name', 'legal name', 'trade name', 'supplier', 'customer'),
+    'igst': ('igst', 'integrated tax'),
+    'cgst': ('cgst', 'central tax'),
+    'sgst': ('sgst', 'state tax', 'utgst'),
+    'inv_no': ('invoice number', 'inv no', 'bill no'),
+    'date': ('invoice date', 'date', 'inv dt'),
+}
+
+# Precompiled helpers for to_float (called for every tax cell)
+_NUM_RE = re.compile(r"-?\d+(?:\.\d+)?")
+_TRANS = str.maketrans('', '', ',\u00A0₹ \t\r\n')
+
+# Whitespace collapsing for header normalization
+_WS_RE = re.compile(r"\s+")
+
+# Sheet-name keywords that identify the purchase register / books side
+_BOOKS_RE = re.compile(r"book|purchase|ledger|pr|register")
+
+# Raw GSTIN cell value -> cleaned, interned GSTIN (see norm_gstin)
+_GSTIN_CACHE = {}
+_GSTIN_CACHE_SIZE = 100_000  # Reset once this many distinct values have been seen
+
 # --- Helper Functions ---
 
+@functools.lru_cache(maxsize=256)
 def classify_sheet(name):
     n = name.lower()
-    if any(x in n for x in ['book', 'purchase', 'ledger', 'pr', 'register']):
+    if _BOOKS_RE.search(n):
         return 'BOOKS'
     if '2b' in n:
         return '2B'
@@ -33,55 +59,62 @@ def find_excel_files():
         files.extend(glob.glob(p))
     return [f for f in files if not os.path.basename(f).startswith('~$')]
 
+@functools.lru_cache(maxsize=4096)
 def normalize_header(h):
+    # Header names repeat across sheets and uploads, so results are cached
     if h is None: return ""
-    return re.sub(r"\s+", " ", str(h).strip().lower())
+    return _WS_RE.sub(" ", str(h).strip().lower())
 
 def to_float(val):
     if val is None: return 0.0
     if isinstance(val, (int, float)): return float(val)
-    s = str(val).strip()
-    if not s: return 0.0
-    # specific cleanup
-    s = s.replace(",", "").replace("\u00A0", "").replace("₹", "")
+    # specific cleanup (thousands separators, NBSP, currency symbol, spaces) in one pass
+    s = val.translate(_TRANS) if isinstance(val, str) else str(val).translate(_TRANS)
     if s.startswith("(") and s.endswith(")"):
         s = "-" + s[1:-1]
     # extract first float-like pattern
-    match = re.search(r"-?\d+(\.\d+)?", s)
-    if match:
-        try:
-            return float(match.group(0))
-        except:
-            return 0.0
-    return 0.0
+    match = _NUM_RE.search(s)
+    return float(match.group()) if match else 0.0
+
+def norm_gstin(val):
+    # GSTINs repeat for every invoice of a vendor, so clean each distinct raw value once and
+    # share a single interned string between all rows that carry it
+    gstin = _GSTIN_CACHE.get(val)
+    if gstin is None:
+        gstin = str(val).strip().upper() if val else ''
+        # Clean GSTIN: sometimes it might be empty or 'None' string
+        if gstin in ('NONE', 'NAN'): gstin = ''
+        if len(_GSTIN_CACHE) >= _GSTIN_CACHE_SIZE:
+            _GSTIN_CACHE.clear()
+        gstin = _GSTIN_CACHE.setdefault(val, sys.intern(gstin))
+    return gstin
+
+def sheet_rows(wb, sheet_name):
+    # All cell values of a sheet as lists, starting at A1 so that list positions match
+    # Excel rows/columns (skip_empty_area would drop leading blank rows and columns)
+    return wb.get_sheet_by_name(sheet_name).to_python(skip_empty_area=False)
 
-def get_header_map(ws):
+def get_header_map(header_row):
     # Find header row (assume row 1 usually, or scan first few)
     # The previous script scanned row 1. Let's do that for simplicity.
     headers = {}
-    for col in range(1, ws.max_column + 1):
-        val = ws.cell(row=1, column=col).value
+    for col, val in enumerate(header_row, start=1):
         norm = normalize_header(val)
         if norm:
             headers[norm] = col
     
-    # Map essential columns
-    mapping = {}
-    
-    def find_col(keywords):
-        for k in keywords:
-            for h in headers:
-                if k in h:
-                    return headers[h]
-        return None
-
-    mapping['gstin'] = find_col(['gstin', 'gst number', 'gst no', 'tin'])
-    mapping['party'] = find_col(['party', 'name', 'legal name', 'trade name', 'supplier', 'customer'])
-    mapping['igst'] = find_col(['igst', 'integrated tax'])
-    mapping['cgst'] = find_col(['cgst', 'central tax'])
-    mapping['sgst'] = find_col(['sgst', 'state tax', 'utgst'])
-    mapping['inv_no'] = find_col(['invoice number', 'inv no', 'bill no'])
-    mapping['date'] = find_col(['invoice date', 'date', 'inv dt'])
+    # Map essential columns in a single pass over the headers. For each field the
+    # earliest keyword wins, and among headers matching the same keyword the first one.
+    mapping = {field: None for field in FIELD_KEYWORDS}
+    best_rank = {}
+    for h, col in headers.items():
+        for field, keywords in FIELD_KEYWORDS.items():
+            # Only keywords ranked above the current best can still change the mapping
+            for rank in range(best_rank.get(field, len(keywords))):
+                if keywords[rank] in h:
+                    mapping[field] = col
+                    best_rank[field] = rank
+                    break
     
     # Fallback for tax if specific columns not found (sometimes just 'Tax Amount') - but user was specific about heads.
     # Assuming standard format based on previous script.
@@ -89,33 +122,32 @@ def get_header_map(ws):
     return mapping
 
 class Invoice:
-    __slots__ = ['row_idx', 'gstin', 'igst', 'cgst', 'sgst', 'party', 'head', 'amount', 'source', 'match_id', 'match_type', 'matched_with_row']
+    # Only the fields used for matching and writing results are kept per row;
+    # the individual tax amounts are reduced to head + amount at construction.
+    __slots__ = ['row_idx', 'gstin', 'party', 'head', 'amount', 'match_id', 'match_type', 'matched_with_row']
 
-    def __init__(self, row_idx, data, source_sheet):
+    def __init__(self, row_idx, data):
         self.row_idx = row_idx
-        self.gstin = str(data.get('gstin', '') or '').strip().upper()
-        # Clean GSTIN: sometimes it might be empty or 'None' string
-        if self.gstin in ['NONE', 'NAN']: self.gstin = ''
+        self.gstin = norm_gstin(data.get('gstin'))
             
-        self.igst = to_float(data.get('igst', 0))
-        self.cgst = to_float(data.get('cgst', 0))
-        self.sgst = to_float(data.get('sgst', 0))
+        igst = to_float(data.get('igst', 0))
+        cgst = to_float(data.get('cgst', 0))
+        sgst = to_float(data.get('sgst', 0))
         self.party = str(data.get('party', '') or '').strip()
         
         # Determine Head and Main Amount
         # USE LOWER THRESHOLD (0.01) to catch small differences
-        if abs(self.igst) > 0.01:
+        if abs(igst) > 0.01:
             self.head = 'IGST'
-            self.amount = self.igst
-        elif abs(self.cgst) > 0.01 or abs(self.sgst) > 0.01:
+            self.amount = igst
+        elif abs(cgst) > 0.01 or abs(sgst) > 0.01:
             self.head = 'CGST/SGST'
             # Use CGST as the match amount.
-            self.amount = self.cgst if abs(self.cgst) > 0.01 else self.sgst
+            self.amount = cgst if abs(cgst) > 0.01 else sgst
         else:
             self.head = 'ZERO'
             self.amount = 0.0
             
-        self.source = source_sheet
         self.match_id = None
         self.match_type = None # 'Perfect', 'Missing GSTIN', 'Amount Only'
         self.matched_with_row = None
@@ -123,255 +155,307 @@ class Invoice:
     def __repr__(self):
         return f"Row:{self.row_idx} GST:{self.gstin} {self.head}:{self.amount}"
 
-def read_invoices(ws, mapping, sheet_name):
+def read_invoices(rows, mapping):
     invoices = []
+    keys = list(mapping.keys())
+    # 0-based positions into each row list (-1 = column not mapped)
+    col_idx = [mapping[k] - 1 if mapping[k] else -1 for k in keys]
     # Data starts from row 2
-    for r in range(2, ws.max_row + 1):
-        data = {}
-        # Check if row is empty
-        is_empty = True
-        for k, col_idx in mapping.items():
-            if col_idx:
-                val = ws.cell(row=r, column=col_idx).value
-                data[k] = val
-                if val is not None and str(val).strip() != "":
-                    is_empty = False
-            else:
-                data[k] = None
-                
-        if not is_empty:
-            inv = Invoice(r, data, sheet_name)
-            # Include everything that is not strictly identified as ZERO tax
-            # This allows Negative amounts (Returns) to be included.
-            if inv.head != 'ZERO':
-                invoices.append(inv)
+    for r, row in enumerate(itertools.islice(rows, 1, None), start=2):
+        # Skip blank rows before building anything. Rows that only hold blanks/zeros
+        # end up as ZERO below, so this is purely an early exit.
+        if row is None or not any(row):
+            continue
+        
+        data = {k: (row[ci] if 0 <= ci < len(row) else None) for k, ci in zip(keys, col_idx)}
+        inv = Invoice(r, data)
+        # Include everything that is not strictly identified as ZERO tax
+        # This allows Negative amounts (Returns) to be included.
+        if inv.head != 'ZERO':
+            invoices.append(inv)
     return invoices
 
-def match_invoices(list1, list2, tolerance, name1, name2):
-    # list1: invoices from sheet 1 (name1)
-    # list2: invoices from sheet 2 (name2)
-    
-    match_counter = 1
-    
-    # Helper to check match
-    def amounts_match(a, b, tol):
-        return abs(a - b) <= tol
+def load_sheet(wb, sheet_name):
+    # Parse a sheet once: the header map is built from its first row, and the same rows
+    # are then used for reading invoices and writing results
+    rows = sheet_rows(wb, sheet_name)
+    return rows, get_header_map(rows[0] if rows else [])
 
-    # --- Phase 1: Perfect Match (Same GSTIN, Same Head, Same Amount) ---
-    print("Running Phase 1: Perfect Matches...")
-    
-    # Index list2 by (GSTIN, Head) for faster lookup
-    # Since we can have multiple matches, we use a list
-    map2 = defaultdict(list)
-    for inv in list2:
-        if not inv.match_id:
-            key = (inv.gstin, inv.head)
-            map2[key].append(inv)
-            
-    for inv1 in list1:
-        if inv1.match_id: continue
+def sort_buckets(index):
+    # Turn {key: [invoices]} into {key: (invoices sorted by amount, amounts)} so that
+    # candidates within tolerance can be located with bisect instead of a full scan
+    sorted_index = {}
+    for k, items in index.items():
+        items.sort(key=lambda x: x.amount)
+        sorted_index[k] = (items, [x.amount for x in items])
+    return sorted_index
+
+def index_by_amount(invoices, key):
+    # Group invoices by key into sorted buckets. Items whose key is None are skipped.
+    index = defaultdict(list)
+    for inv in invoices:
+        k = key(inv)
+        if k is not None:
+            index[k].append(inv)
+    return sort_buckets(index)
+
+def index_by_head(invoices):
+    # Split invoices by Head into (no GSTIN, with GSTIN) sorted buckets in a single pass
+    no_gstin = defaultdict(list)
+    with_gstin = defaultdict(list)
+    for inv in invoices:
+        (with_gstin if inv.gstin else no_gstin)[inv.head].append(inv)
+    return sort_buckets(no_gstin), sort_buckets(with_gstin)
+
+def remove_from_bucket(bucket, inv):
+    # Drop a matched invoice from a sorted bucket so later lookups never see it again
+    items, amounts = bucket
+    i = bisect.bisect_left(amounts, inv.amount)
+    while items[i] is not inv:
+        i += 1
+    del items[i]
+    del amounts[i]
+
+def find_best_match(bucket, amount, tolerance):
+    # Closest candidate within tolerance; on equal difference the earlier row wins.
+    # Start at the insertion point and walk outward while abs(diff) <= tolerance, so the
+    # acceptance test is exactly the same as a full scan (no rounded amount +/- tolerance bounds).
+    items, amounts = bucket
+    idx = bisect.bisect_left(amounts, amount)
+    
+    best_match = None
+    best_diff = float('inf')
+    
+    # Check right side (including idx)
+    for i in range(idx, len(items)):
+        diff = abs(amount - amounts[i])
+        if diff > tolerance:
+            break
+        if diff < best_diff or (diff == best_diff and items[i].row_idx < best_match.row_idx):
+            best_diff = diff
+            best_match = items[i]
+    
+    # Check left side
+    for i in range(idx - 1, -1, -1):
+        diff = abs(amount - amounts[i])
+        if diff > tolerance:
+            break
+        if diff < best_diff or (diff == best_diff and items[i].row_idx < best_match.row_idx):
+            best_diff = diff
+            best_match = items[i]
+    return best_match
+
+def sweep_matches(items1, items2, tolerance):
+    # Pair items by amount with a single merge-style walk over both lists sorted by amount.
+    # The window holds the still-unmatched items2 with abs(diff) <= tolerance; it only ever
+    # slides right, and matched items are removed from it so they are never revisited.
+    # Window edges compare the difference itself (not rounded amount +/- tolerance bounds),
+    # so pairs exactly at the tolerance are kept.
+    items1 = sorted(items1, key=lambda x: x.amount)
+    # Candidates with equal amounts stay in row order, so ties go to the earlier row
+    items2 = sorted(items2, key=lambda x: (x.amount, x.row_idx))
+    
+    window = []
+    window_amounts = []
+    hi = 0
+    for inv1 in items1:
+        amount = inv1.amount
         
-        key = (inv1.gstin, inv1.head)
-        candidates = map2.get(key, [])
+        # Extend the window with candidates up to tolerance above amount
+        while hi < len(items2) and items2[hi].amount - amount <= tolerance:
+            window.append(items2[hi])
+            window_amounts.append(items2[hi].amount)
+            hi += 1
         
-        best_match = None
-        best_diff = float('inf')
+        # Drop candidates more than tolerance below amount (they are too small for every later item too)
+        lo = 0
+        while lo < len(window_amounts) and amount - window_amounts[lo] > tolerance:
+            lo += 1
+        if lo:
+            del window[:lo]
+            del window_amounts[:lo]
+        if not window: continue
         
-        # Find best amount match within tolerance
-        for candidate in candidates:
-            if candidate.match_id: continue
-            
-            diff = abs(inv1.amount - candidate.amount)
-            if diff <= tolerance and diff < best_diff:
+        # Closest candidate is next to the insertion point; on equal difference the earlier row wins
+        best_idx = None
+        best_diff = float('inf')
+        idx = bisect.bisect_left(window_amounts, amount)
+        if idx < len(window):
+            best_idx = idx
+            best_diff = abs(amount - window_amounts[idx])
+        if idx > 0:
+            left_idx = bisect.bisect_left(window_amounts, window_amounts[idx - 1])
+            diff = abs(amount - window_amounts[left_idx])
+            if diff < best_diff or (diff == best_diff and window[left_idx].row_idx < window[best_idx].row_idx):
+                best_idx = left_idx
                 best_diff = diff
-                best_match = candidate
         
-        if best_match:
-            # Link them
-            inv1.match_id = match_counter
-            best_match.match_id = match_counter
-            inv1.match_type = "Perfect Match"
-            best_match.match_type = "Perfect Match"
-            inv1.matched_with_row = best_match.row_idx
-            best_match.matched_with_row = inv1.row_idx
-            match_counter += 1
+        if best_diff > tolerance: continue
+        
+        best_match = window.pop(best_idx)
+        del window_amounts[best_idx]
+        yield inv1, best_match
 
-    # --- Phase 2: Missing GSTIN (One side has GSTIN, other is blank, Head+Amount Match) ---
-    # User might mean: If GSTIN is missing in one sheet but present in another.
-    print("Running Phase 2: Missing GSTIN Matches...")
-    
-    # Re-index remaining unmatched items in list2 by Head only
-    # But specifically target those with EMPTY GSTIN in list2 if list1 has GSTIN, or vice-versa
+def link_match(inv1, inv2, match_id, match_type):
+    inv1.match_id = match_id
+    inv2.match_id = match_id
+    inv1.match_type = match_type
+    inv2.match_type = match_type
+    inv1.matched_with_row = inv2.row_idx
+    inv2.matched_with_row = inv1.row_idx
+
+def match_perfect(list1, list2, map2_no_gstin, map2_with_gstin, tolerance, match_counter):
+    # Phase 1: Same GSTIN, Same Head, Same Amount.
+    # The (GSTIN, Head) index is only needed here and is released when this returns.
+    map2 = index_by_amount(list2, lambda inv: (inv.gstin, inv.head))
     
-    # Sub-case A: List1 has GSTIN, List2 has NO GSTIN
-    map2_no_gstin = defaultdict(list)
-    for inv in list2:
-        if not inv.match_id and not inv.gstin:
-            map2_no_gstin[inv.head].append(inv)
-            
     for inv1 in list1:
         if inv1.match_id: continue
-        if not inv1.gstin: continue # We need GSTIN here to call it "Missing GSTIN match" (one side has it)
         
-        candidates = map2_no_gstin.get(inv1.head, [])
-        best_match = None
-        best_diff = float('inf')
+        bucket = map2.get((inv1.gstin, inv1.head))
+        if not bucket: continue
         
-        for candidate in candidates:
-            if candidate.match_id: continue
-            diff = abs(inv1.amount - candidate.amount)
-            if diff <= tolerance and diff < best_diff:
-                best_diff = diff
-                best_match = candidate
+        # Find best amount match within tolerance
+        best_match = find_best_match(bucket, inv1.amount, tolerance)
         
         if best_match:
-            inv1.match_id = match_counter
-            best_match.match_id = match_counter
-            inv1.match_type = f"Match (Missing GSTIN in {name2})"
-            best_match.match_type = f"Match (Missing GSTIN in {name2})"
-            inv1.matched_with_row = best_match.row_idx
-            best_match.matched_with_row = inv1.row_idx
+            # Remove it from every index it is in, then link them
+            remove_from_bucket(bucket, best_match)
+            remove_from_bucket((map2_with_gstin if best_match.gstin else map2_no_gstin)[best_match.head], best_match)
+            link_match(inv1, best_match, match_counter, "Perfect Match")
             match_counter += 1
-            
-    # Sub-case B: List1 has NO GSTIN, List2 has GSTIN
-    # Index list2 items that HAVE GSTIN
-    map2_with_gstin = defaultdict(list)
-    for inv in list2:
-        if not inv.match_id and inv.gstin:
-            map2_with_gstin[inv.head].append(inv)
-            
+    return match_counter
+
+def match_missing_gstin(list1, map2_head, list1_has_gstin, tolerance, match_type, match_counter):
+    # Phase 2: GSTIN present on one side only, Head + Amount match.
+    # map2_head holds the list2 items on the opposite side of list1_has_gstin.
     for inv1 in list1:
         if inv1.match_id: continue
-        if inv1.gstin: continue 
+        if bool(inv1.gstin) != list1_has_gstin: continue
         
-        candidates = map2_with_gstin.get(inv1.head, [])
-        best_match = None
-        best_diff = float('inf')
+        bucket = map2_head.get(inv1.head)
+        if not bucket: continue
+        best_match = find_best_match(bucket, inv1.amount, tolerance)
         
-        for candidate in candidates:
-            if candidate.match_id: continue
-            diff = abs(inv1.amount - candidate.amount)
-            if diff <= tolerance and diff < best_diff:
-                best_diff = diff
-                best_match = candidate
-                
         if best_match:
-            inv1.match_id = match_counter
-            best_match.match_id = match_counter
-            inv1.match_type = f"Match (Missing GSTIN in {name1})"
-            best_match.match_type = f"Match (Missing GSTIN in {name1})"
-            inv1.matched_with_row = best_match.row_idx
-            best_match.matched_with_row = inv1.row_idx
+            remove_from_bucket(bucket, best_match)
+            link_match(inv1, best_match, match_counter, match_type)
             match_counter += 1
+    return match_counter
 
-    # Free up memory explicitly
-    map2_no_gstin.clear()
-    map2_with_gstin.clear()
-    map2.clear()
-    gc.collect()
-
-    # --- Phase 3: Amount Match (GSTIN Mismatch / Both have different GSTINs or both missing) ---
-    print("Running Phase 3: Amount Only Matches...")
-    
-    # Index remaining list2 by Head
-    map2_any = defaultdict(list)
-    for inv in list2:
+def match_amount_only(list1, map2_no_gstin, map2_with_gstin, tolerance, match_counter):
+    # Phase 3: Amount match (GSTIN mismatch / both have different GSTINs or both missing)
+    # Group remaining list1 items by Head
+    map1_any = defaultdict(list)
+    for inv in list1:
         if not inv.match_id:
-            map2_any[inv.head].append(inv)
-            
-    # Sort candidates by amount for binary search
-    sorted_candidates_map = {}
-    candidates_amounts_map = {} # Pre-calculate amounts for bisect
-    
-    for head, items in map2_any.items():
-        # filtering out items that might have been matched in previous phases
-        valid_items = [x for x in items if not x.match_id]
-        valid_items.sort(key=lambda x: x.amount)
-        sorted_candidates_map[head] = valid_items
-        candidates_amounts_map[head] = [x.amount for x in valid_items]
-        
-    for inv1 in list1:
-        if inv1.match_id: continue
-        
-        candidates = sorted_candidates_map.get(inv1.head, [])
-        candidate_amounts = candidates_amounts_map.get(inv1.head, [])
-        
-        if not candidates: continue
-        
-        # Binary search using pre-calculated list
-        idx = bisect.bisect_left(candidate_amounts, inv1.amount)
-        
-        best_match = None
-        best_diff = float('inf')
-        
-        # Check right side (including idx)
-        for i in range(idx, len(candidates)):
-            # Optimization: strictly sorted
-            diff = abs(candidates[i].amount - inv1.amount)
-            if diff > tolerance:
-                break 
-            
-            if candidates[i].match_id: continue
-            
-            if diff < best_diff:
-                best_diff = diff
-                best_match = candidates[i]
-                
-        # Check left side
-        for i in range(idx - 1, -1, -1):
-            diff = abs(candidates[i].amount - inv1.amount)
-            if diff > tolerance:
-                break
-                
-            if candidates[i].match_id: continue
-            
-            if diff < best_diff:
-                best_diff = diff
-                best_match = candidates[i]
+            map1_any[inv.head].append(inv)
+    
+    # The list2 side is what is left in the Phase 2 indices
+    for head, items1 in map1_any.items():
+        items2 = map2_no_gstin.get(head, ([], []))[0] + map2_with_gstin.get(head, ([], []))[0]
+        if not items2: continue
         
-        if best_match:
-            inv1.match_id = match_counter
-            best_match.match_id = match_counter
-            
+        for inv1, best_match in sweep_matches(items1, items2, tolerance):
             # Check if GSTINs are present but differ
             if inv1.gstin and best_match.gstin and inv1.gstin != best_match.gstin:
                 match_desc = "Probable Match (GSTIN Mismatch)"
             else:
                  # Both empty?
                 match_desc = "Match (No GSTINs)"
-                
-            inv1.match_type = match_desc
-            best_match.match_type = match_desc
-            inv1.matched_with_row = best_match.row_idx
-            best_match.matched_with_row = inv1.row_idx
+            
+            link_match(inv1, best_match, match_counter, match_desc)
             match_counter += 1
+    return match_counter
+
+def match_invoices(list1, list2, tolerance, name1, name2):
+    # list1: invoices from sheet 1 (name1)
+    # list2: invoices from sheet 2 (name2)
+    # Each phase runs in its own helper so its temporary indices are freed as soon as it returns.
+    
+    match_counter = 1
+    
+    # Index list2 by Head, split on whether GSTIN is present. Matched items are removed
+    # from these indices, so whatever is left is exactly what Phase 3 has to consider.
+    map2_no_gstin, map2_with_gstin = index_by_head(list2)
+
+    # --- Phase 1: Perfect Match (Same GSTIN, Same Head, Same Amount) ---
+    print("Running Phase 1: Perfect Matches...")
+    match_counter = match_perfect(list1, list2, map2_no_gstin, map2_with_gstin, tolerance, match_counter)
+
+    # --- Phase 2: Missing GSTIN (One side has GSTIN, other is blank, Head+Amount Match) ---
+    # User might mean: If GSTIN is missing in one sheet but present in another.
+    print("Running Phase 2: Missing GSTIN Matches...")
+    
+    # Sub-case A: List1 has GSTIN, List2 has NO GSTIN
+    match_counter = match_missing_gstin(list1, map2_no_gstin, True, tolerance,
+                                        f"Match (Missing GSTIN in {name2})", match_counter)
+    # Sub-case B: List1 has NO GSTIN, List2 has GSTIN
+    match_counter = match_missing_gstin(list1, map2_with_gstin, False, tolerance,
+                                        f"Match (Missing GSTIN in {name1})", match_counter)
+
+    # --- Phase 3: Amount Match (GSTIN Mismatch / Both have different GSTINs or both missing) ---
+    print("Running Phase 3: Amount Only Matches...")
+    match_counter = match_amount_only(list1, map2_no_gstin, map2_with_gstin, tolerance, match_counter)
 
     return match_counter
 
-def write_results(ws, invoices, this_name, other_name):
-    # Determine max column to append
-    max_col = ws.max_column
+def write_results(out_ws, rows, invoices, this_name, other_name):
+    # Copy the input rows into the output sheet, appending the
+    # match columns after the last input column
+    header = rows[0] if rows else []
+    max_col = max((len(row) for row in rows), default=0)
     
     # Headers
-    ws.cell(row=1, column=max_col+1, value="Match_Status")
-    ws.cell(row=1, column=max_col+2, value="Match_ID")
-    ws.cell(row=1, column=max_col+3, value="Matched_Row_Idx")
+    out_ws.write_row(0, 0, header)
+    out_ws.write_row(0, max_col, ("Match_Status", "Match_ID", "Matched_Row_Idx"))
     
     # Map by row index for easy writing
     inv_map = {inv.row_idx: inv for inv in invoices}
     
-    for r in range(2, ws.max_row + 1):
-        if r in inv_map:
-            inv = inv_map[r]
+    # Rows must be written in order: in constant_memory mode each row is flushed to disk
+    # as soon as the next one starts
+    for r, row in enumerate(itertools.islice(rows, 1, None), start=2):
+        out_ws.write_row(r - 1, 0, row)
+        inv = inv_map.get(r)
+        if inv:
             # Descriptive status
             status = inv.match_type if inv.match_type else f"Missing in {other_name}"
-            
-            ws.cell(row=r, column=max_col+1, value=status)
-            ws.cell(row=r, column=max_col+2, value=inv.match_id)
-            ws.cell(row=r, column=max_col+3, value=inv.matched_with_row)
+            out_ws.write_row(r - 1, max_col, (status, inv.match_id, inv.matched_with_row))
         else:
             # Rows that were skipped (e.g. zero value)
-            ws.cell(row=r, column=max_col+1, value="Ignored/Zero")
+            out_ws.write(r - 1, max_col, "Ignored/Zero")
+
+def save_results(wb, out_file, results):
+    # results: {sheet_name: (rows, invoices, other_sheet_name)} for the two reconciled sheets.
+    # Other sheets are copied through unchanged. Cell text is written as-is (no formula/URL
+    # conversion) and blank "" cells from calamine are written as blanks by xlsxwriter.
+    out_wb = xlsxwriter.Workbook(out_file, {
+        'constant_memory': True,
+        'use_zip64': True,
+        'strings_to_formulas': False,
+        'strings_to_urls': False,
+        'default_date_format': 'yyyy-mm-dd',
+    })
+    # calamine returns date for date-only cells; datetime and time values need a format
+    # that keeps the time of day, so route them through their own write handlers
+    time_formats = {
+        datetime.datetime: out_wb.add_format({'num_format': 'yyyy-mm-dd hh:mm:ss'}),
+        datetime.time: out_wb.add_format({'num_format': 'hh:mm:ss'}),
+    }
+    def write_with_time(ws, row, col, value, cell_format=None):
+        return ws.write_datetime(row, col, value, cell_format or time_formats[value.__class__])
+    for name in wb.sheet_names:
+        out_ws = out_wb.add_worksheet(name)
+        for value_type in time_formats:
+            out_ws.add_write_handler(value_type, write_with_time)
+        if name in results:
+            rows, invoices, other_name = results[name]
+            write_results(out_ws, rows, invoices, name, other_name)
+        else:
+            for r, row in enumerate(sheet_rows(wb, name)):
+                out_ws.write_row(r, 0, row)
+    out_wb.close()
 
 def main():
     import argparse
@@ -413,8 +497,8 @@ def main():
             pass
             
     print(f"Loading {path}...")
-    wb = load_workbook(path)
-    sheets = wb.sheetnames
+    wb = CalamineWorkbook.from_path(path)
+    sheets = wb.sheet_names
     
     name1 = args.sheet1
     name2 = args.sheet2
@@ -470,21 +554,17 @@ def main():
         print("Error: Sheet 1 and Sheet 2 must be different.")
         return
 
-    ws1 = wb[name1]
-    ws2 = wb[name2]
-    
-    print("Analyzing headers...")
-    map1 = get_header_map(ws1)
-    map2 = get_header_map(ws2)
+    # Read data
+    print("Reading data...")
+    rows1, map1 = load_sheet(wb, name1)
+    rows2, map2 = load_sheet(wb, name2)
     
     # Verify mappings
     print(f"Sheet '{name1}' columns detected: { {k:v for k,v in map1.items() if v} }")
     print(f"Sheet '{name2}' columns detected: { {k:v for k,v in map2.items() if v} }")
     
-    # Read data
-    print("Reading data...")
-    inv1 = read_invoices(ws1, map1, name1)
-    inv2 = read_invoices(ws2, map2, name2)
+    inv1 = read_invoices(rows1, map1)
+    inv2 = read_invoices(rows2, map2)
     
     print(f"Loaded {len(inv1)} records from {name1}")
     print(f"Loaded {len(inv2)} records from {name2}")
@@ -495,21 +575,16 @@ def main():
     
     # Write Results
     print("Writing results...")
-    write_results(ws1, inv1, name1, name2)
-    write_results(ws2, inv2, name2, name1)
-    
-    # Save
-    # Save
     ts = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
     out_file = f"{os.path.splitext(path)[0]}_RECON_{ts}.xlsx"
-    wb.save(out_file)
+    save_results(wb, out_file, {name1: (rows1, inv1, name2), name2: (rows2, inv2, name1)})
+    wb.close()
     print(f"Saved to {out_file}")
     return out_file
 
-def process_reconciliation(path, sheet1=None, sheet2=None, tolerance=DEFAULT_TOLERANCE):
-    print(f"Processing {path}...")
-    wb = load_workbook(path)
-    sheets = wb.sheetnames
+def detect_sheets(wb, sheet1=None, sheet2=None):
+    # Resolve the two sheets to reconcile
+    sheets = wb.sheet_names
     
     name1 = sheet1
     name2 = sheet2
@@ -544,41 +619,43 @@ def process_reconciliation(path, sheet1=None, sheet2=None, tolerance=DEFAULT_TOL
     if name1 not in sheets or name2 not in sheets:
         raise ValueError(f"One of the sheets not found. Available: {sheets}")
 
-    ws1 = wb[name1]
-    ws2 = wb[name2]
-    
-    map1 = get_header_map(ws1)
-    map2 = get_header_map(ws2)
-    
+    return name1, name2
+
+def validate_map(m, sheet_name):
     # Validation logic
     required_cols = ['gstin']
     tax_cols = ['igst', 'cgst', 'sgst']
     
-    def validate_map(m, sheet_name):
-        missing = [c for c in required_cols if not m.get(c)]
-        if missing:
-            raise ValueError(f"Sheet '{sheet_name}' is missing required columns: {', '.join(missing)}")
-        
-        # Check if at least one tax column exists? Or just warn?
-        # User requested specific error like "No IGST column found"
-        # Let's be strict about tax columns if possible, or at least check if ALL are missing
-        if not any(m.get(c) for c in tax_cols):
-             raise ValueError(f"Sheet '{sheet_name}' has no tax columns (IGST, CGST, or SGST found).")
+    missing = [c for c in required_cols if not m.get(c)]
+    if missing:
+        raise ValueError(f"Sheet '{sheet_name}' is missing required columns: {', '.join(missing)}")
+    
+    # Check if at least one tax column exists? Or just warn?
+    # User requested specific error like "No IGST column found"
+    # Let's be strict about tax columns if possible, or at least check if ALL are missing
+    if not any(m.get(c) for c in tax_cols):
+         raise ValueError(f"Sheet '{sheet_name}' has no tax columns (IGST, CGST, or SGST found).")
 
+def process_reconciliation(path, sheet1=None, sheet2=None, tolerance=DEFAULT_TOLERANCE):
+    print(f"Processing {path}...")
+    wb = CalamineWorkbook.from_path(path)
+    
+    name1, name2 = detect_sheets(wb, sheet1, sheet2)
+    
+    rows1, map1 = load_sheet(wb, name1)
+    rows2, map2 = load_sheet(wb, name2)
     validate_map(map1, name1)
     validate_map(map2, name2)
     
-    inv1 = read_invoices(ws1, map1, name1)
-    inv2 = read_invoices(ws2, map2, name2)
+    inv1 = read_invoices(rows1, map1)
+    inv2 = read_invoices(rows2, map2)
     
     match_invoices(inv1, inv2, tolerance, name1, name2)
     
-    write_results(ws1, inv1, name1, name2)
-    write_results(ws2, inv2, name2, name1)
-    
     ts = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
     out_file = f"{os.path.splitext(path)[0]}_RECON_{ts}.xlsx"
-    wb.save(out_file)
+    save_results(wb, out_file, {name1: (rows1, inv1, name2), name2: (rows2, inv2, name1)})
+    wb.close()
     return out_file
 
 if __name__ == "__main__":